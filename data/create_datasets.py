@@ -1,84 +1,299 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from math import pi
+
 import pandas as pd
 import numpy as np
-from math import cos, asin, sqrt, pi
-
-######### Load in sensor info #########
-vds_info = pd.read_csv('vds_info.csv')
-
-######### Create dataframe for speeds and add lanes to sensor info #########
-print('Reading in sensor speeds...')
-speed_data = []
-lane_data = []
-for ind, row in vds_info.iterrows():
-    # Filepath for each week
-    w1_file = str(row['vds_id']) + '_' + row['Freeway'] + row['Direction'] + '_W1' + '.csv'
-    w2_file = str(row['vds_id']) + '_' + row['Freeway'] + row['Direction'] + '_W2' + '.csv'
-    folder = 'SD_' + row['Freeway'] + '/'
-    
-    # Load in dataset for each week
-    w1_df = pd.read_csv('sensor_speeds/'+folder+w1_file)
-    w2_df = pd.read_csv('sensor_speeds/'+folder+w2_file)
-    
-    # Check that both datasets contain 1 weeks worth of 5 min intervals (1 day = 288 intervals * 7 days = 2016)
-    if (len(w1_df) != 2016) or (len(w2_df) != 2016):
-        print(str(row['vds_id']) + ' does not contain all times')
-        continue
-    
-    # Create row representing all speeds for one sensor
-    speed_row = [row['vds_id']] + list(w1_df['Speed (mph)']) + list(w2_df['Speed (mph)'])
-    speed_data.append(speed_row)
-    
-    lane_data.append(w1_df['# Lane Points'][0]) # Assuming that # of lanes never changes
-    
-time_ints = list(w1_df['5 Minutes']) + list(w2_df['5 Minutes']) # Get all time intervals to use as columns
-cols = ['vds_id'] + time_ints
-
-sensor_speed = pd.DataFrame(speed_data, columns=cols).set_index('vds_id')
-vds_info = vds_info.assign(Lanes=lane_data).set_index('vds_id')
-
-# Find distance (in miles) between two coordinates 
+
+# Number of 5 minute intervals in one week of data (1 day = 288 intervals * 7 days = 2016)
+WEEK_SLOTS = 2016
+
+# Only these columns are read from the raw sensor files
+SPEED_COLS = ['5 Minutes', 'Speed (mph)', '# Lane Points']
+
+######### Functions for reading in sensor speeds #########
+
+def sensor_file(vds_id, freeway, direction, week):
+    # Filepath for one week of one sensor
+    file = str(vds_id) + '_' + freeway + direction + '_' + week + '.csv'
+    return os.path.join('sensor_speeds', 'SD_' + freeway, file)
+
+def find_weeks():
+    # Labels (W1, W2, ...) of all weeks that have raw sensor files, in order
+    weeks = set()
+    for folder in os.listdir('sensor_speeds'):
+        for file in os.listdir(os.path.join('sensor_speeds', folder)):
+            match = re.search(r'_(W\d+)\.csv$', file)
+            if match:
+                weeks.add(match.group(1))
+    return sorted(weeks, key=lambda week: int(week[1:]))
+
+def read_sensor(vds_id, freeway, direction, weeks):
+    """Read and validate the given weeks of speeds for one sensor.
+
+    Returns (speeds, lanes, times), or None if any week does not contain all times.
+    """
+    speeds = []
+    times = []
+    lanes = None
+    for week in weeks:
+        path = sensor_file(vds_id, freeway, direction, week)
+        if not os.path.exists(path):
+            return None
+
+        # The time column is always first but its header is not consistent across files,
+        # and some files have extra per lane columns, so select the columns once read
+        df = pd.read_csv(path)
+        df = df[[df.columns[0], 'Speed (mph)', '# Lane Points']].set_axis(SPEED_COLS, axis=1)
+
+        # Check that the dataset contains 1 weeks worth of 5 min intervals
+        if len(df) != WEEK_SLOTS:
+            return None
+
+        speeds.append(df['Speed (mph)'].to_numpy(dtype=np.float32))
+        times.extend(df['5 Minutes'])
+        if lanes is None:
+            lanes = df['# Lane Points'].iloc[0] # Assuming that # of lanes never changes
+
+    return np.concatenate(speeds), lanes, times
+
+def times_digest(times):
+    # Hash of the time labels of a sensor, to compare them without sending them between processes
+    return hashlib.sha1('\n'.join(times).encode()).hexdigest()
+
+def _read_sensor_job(args):
+    # The times of every sensor should be the same, so workers only return their digest
+    result = read_sensor(*args)
+    if result is None:
+        return None
+    sensor_speeds, sensor_lanes, sensor_times = result
+    return sensor_speeds, sensor_lanes, times_digest(sensor_times)
+
+def read_speeds(vds_info, weeks, workers=None):
+    """Read the speeds of every sensor in vds_info with a pool of worker processes.
+
+    Speeds are written straight into a preallocated (n_time, n_sensor) float32 array.
+    Sensors missing any times, or whose times differ from those of the first valid sensor,
+    are dropped. Returns (speeds, lanes, times, valid) where `valid` is a boolean mask over
+    the rows of vds_info.
+    """
+    jobs = list(zip(vds_info['vds_id'], vds_info['Freeway'], vds_info['Direction'], [weeks] * len(vds_info)))
+
+    speeds = np.empty((len(weeks) * WEEK_SLOTS, len(jobs)), dtype=np.float32)
+    lanes = np.empty(len(jobs), dtype=np.int64)
+    valid = np.zeros(len(jobs), dtype=bool)
+    reference = None
+
+    n_valid = 0
+    chunksize = max(1, len(jobs) // (4 * (workers or os.cpu_count() or 1)))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for ind, result in enumerate(pool.map(_read_sensor_job, jobs, chunksize=chunksize)):
+            if result is None:
+                print(str(jobs[ind][0]) + ' does not contain all times')
+                continue
+
+            sensor_speeds, sensor_lanes, digest = result
+            if reference is None:
+                reference = ind
+                reference_digest = digest
+            elif digest != reference_digest:
+                print(str(jobs[ind][0]) + ' does not have the same times as ' + str(jobs[reference][0]))
+                continue
+
+            speeds[:, n_valid] = sensor_speeds
+            lanes[n_valid] = sensor_lanes
+            valid[ind] = True
+            n_valid += 1
+
+    # All time intervals to use as the time index, read once from the first valid sensor
+    times = None
+    if reference is not None:
+        times = read_sensor(*jobs[reference])[2]
+
+    return speeds[:, :n_valid], lanes[:n_valid], times, valid
+
+def parse_times(times):
+    # Convert '%m/%d/%Y %H:%M' strings into a datetime64 array
+    return pd.to_datetime(times, format='%m/%d/%Y %H:%M').to_numpy(dtype='datetime64[m]')
+
+######### Functions for storing speeds #########
+
+def speed_stats(speeds):
+    # Statistics used to z-score the speeds, in a form that can be merged with merge_stats
+    return {'count': int(speeds.size),
+            'mean': float(np.mean(speeds, dtype=np.float64)),
+            'std': float(np.std(speeds, dtype=np.float64))}
+
+def merge_stats(a, b):
+    # Combine the statistics of two sets of speeds (Chan et al. parallel variance)
+    count = a['count'] + b['count']
+    delta = b['mean'] - a['mean']
+    m2 = a['std']**2 * a['count'] + b['std']**2 * b['count'] + delta**2 * a['count'] * b['count'] / count
+    return {'count': count,
+            'mean': a['mean'] + delta * b['count'] / count,
+            'std': float(np.sqrt(m2 / count))}
+
+def write_meta(weeks, stats):
+    # Weeks already stored in sensor_speed.npy and the speed normalization statistics
+    with open('sensor_speed.json', 'w') as f:
+        json.dump({'weeks': weeks, **stats}, f, indent=4)
+
+def read_meta():
+    with open('sensor_speed.json') as f:
+        meta = json.load(f)
+    weeks = meta.pop('weeks')
+    return weeks, meta
+
+def append_rows(path, rows):
+    """Append rows along the first axis of a .npy file in place.
+
+    Only the new rows are written and the header is rewritten with the new shape. NumPy
+    pads .npy headers so that the shape can grow without changing the header length.
+    """
+    with open(path, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        header_len = f.tell()
+
+        rows = np.ascontiguousarray(rows, dtype=dtype)
+        if fortran_order or rows.shape[1:] != shape[1:]:
+            raise ValueError(f'Cannot append rows of shape {rows.shape} to {path} with shape {shape}')
+
+        header = BytesIO()
+        header_data = {'descr': np.lib.format.dtype_to_descr(dtype),
+                       'fortran_order': False,
+                       'shape': (shape[0] + rows.shape[0],) + shape[1:]}
+        if version == (1, 0):
+            np.lib.format.write_array_header_1_0(header, header_data)
+        else:
+            np.lib.format.write_array_header_2_0(header, header_data)
+        if len(header.getvalue()) != header_len:
+            raise ValueError(f'Header of {path} has no room to grow, rebuild the datasets instead')
+
+        # Write the rows before the header so an interrupted append leaves the old array
+        f.seek(header_len + int(np.prod(shape)) * dtype.itemsize)
+        f.write(rows.tobytes())
+        f.truncate()
+        f.seek(0)
+        f.write(header.getvalue())
+
+# Find distance (in miles) between two coordinates. Works elementwise on NumPy arrays,
+# so column and row vectors of coordinates broadcast to a full distance matrix
 # Source: https://stackoverflow.com/questions/27928/calculate-distance-between-two-latitude-longitude-points-haversine-formula
 def distance(lat1, lon1, lat2, lon2):
     r = 3956 # miles
     p = pi / 180
 
-    a = 0.5 - cos((lat2-lat1)*p)/2 + cos(lat1*p) * cos(lat2*p) * (1-cos((lon2-lon1)*p))/2
-    return 2 * r * asin(sqrt(a))
-
-####### Create dataframe for distances between sensors and connectivity between sensors #########
-sensor_list = list(vds_info.index)
-sensor_dist = pd.DataFrame(index=sensor_list, columns=sensor_list) 
-sensor_conn = pd.DataFrame(index=sensor_list, columns=sensor_list)
-for sen1 in sensor_list:
-    for sen2 in sensor_list:
-        if sen1 == sen2:
-            sensor_dist.loc[sen1, sen2] = 0.0
-            sensor_conn.loc[sen1, sen2] = 1
-            continue
-            
-        # Find distances (miles) for all pairs of sensors
-        sen1_lat = vds_info.loc[sen1, 'Lat']
-        sen1_lon = vds_info.loc[sen1, 'Lng']
-        sen2_lat = vds_info.loc[sen2, 'Lat']
-        sen2_lon = vds_info.loc[sen2, 'Lng']
-        
-        sensor_dist.loc[sen1, sen2] = distance(sen1_lat, sen1_lon, sen2_lat, sen2_lon)
-        
-        # Find connectivity for all pairs of sensors
-        if (vds_info.loc[sen1]['Freeway'] == vds_info.loc[sen2]['Freeway']) and (vds_info.loc[sen1]['Direction'] == vds_info.loc[sen2]['Direction']):
-            sensor_conn.loc[sen1, sen2] = 1
-        else:
-            sensor_conn.loc[sen1, sen2] = 0
+    a = 0.5 - np.cos((lat2-lat1)*p)/2 + np.cos(lat1*p) * np.cos(lat2*p) * (1-np.cos((lon2-lon1)*p))/2
+    return 2 * r * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+# Number of rows of the distance matrix computed at once. Peak temporary memory is
+# roughly DIST_BLOCK_SIZE * n_sensors * 40 bytes (~400MB for 20k sensors)
+DIST_BLOCK_SIZE = 512
+
+def distance_matrix(lat, lon, block_size=DIST_BLOCK_SIZE, out=None):
+    """Pairwise haversine distances (miles) between all sensors.
+
+    Rows are computed in tiles of `block_size` so temporary memory stays bounded. Pass
+    `out` (e.g. a memory-mapped array from np.lib.format.open_memmap) to stream the
+    matrix to disk when it does not fit in memory.
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    n = len(lat)
+    if out is None:
+        out = np.empty((n, n), dtype=np.float64)
+    if block_size is None:
+        block_size = max(n, 1)
+
+    for sta in range(0, n, block_size):
+        end = min(sta + block_size, n)
+        out[sta:end] = distance(lat[sta:end, None], lon[sta:end, None], lat[None, :], lon[None, :])
+    return out
+
+def append(workers=None):
+    """Add weeks that are not in the stored datasets yet without rebuilding them.
+
+    Only the raw files of the new weeks are read and validated. Their speeds and times are
+    appended to sensor_speed.npy and sensor_times.npy in place and the normalization
+    statistics are updated from the new speeds alone.
+    """
+    stored_weeks, stats = read_meta()
+    new_weeks = [week for week in find_weeks() if week not in stored_weeks]
+    if len(new_weeks) == 0:
+        print('No new weeks to add')
+        return
+
+    print('Reading in sensor speeds for ' + ', '.join(new_weeks) + '...')
+    vds_info = pd.read_csv('vds_info_w_lanes.csv')
+    speeds, _, time_ints, valid = read_speeds(vds_info, new_weeks, workers=workers)
+
+    # Every stored sensor needs the new weeks, otherwise the speed matrix is not complete
+    if not valid.all():
+        missing = ', '.join(str(vds_id) for vds_id in vds_info['vds_id'][~valid])
+        raise ValueError('Cannot append ' + ', '.join(new_weeks) + ', missing times for sensors: ' + missing)
+
+    times = parse_times(time_ints)
+    stored_times = np.load('sensor_times.npy', mmap_mode='r')
+    if times[0] <= stored_times[-1]:
+        raise ValueError('New weeks must start after ' + str(stored_times[-1]))
+    del stored_times
+
+    print('Appending datasets...')
+
+    append_rows('sensor_speed.npy', speeds)
+    append_rows('sensor_times.npy', times)
+    write_meta(stored_weeks + new_weeks, merge_stats(stats, speed_stats(speeds)))
+
+    print('Done!')
+
+def main(workers=None):
+    ######### Load in sensor info #########
+    vds_info = pd.read_csv('vds_info.csv')
+
+    ######### Read in speeds and add lanes to sensor info #########
+    print('Reading in sensor speeds...')
+    weeks = find_weeks()
+    speeds, lanes, time_ints, valid = read_speeds(vds_info, weeks, workers=workers)
+
+    vds_info = vds_info[valid].assign(Lanes=lanes).set_index('vds_id')
+
+    print('Creaing datasets...')
+
+    # Speeds are stored as (n_time, n_sensor) float32 with an explicit time index. The
+    # columns follow the row order of vds_info_w_lanes.csv
+    np.save('sensor_speed.npy', speeds)
+    np.save('sensor_times.npy', parse_times(time_ints))
+    write_meta(weeks, speed_stats(speeds))
+    vds_info.to_csv('vds_info_w_lanes.csv', index=True)
 
-######### Create dataframe for nonconnectivity between sensors #########
-non_conn = (np.ones(sensor_conn.shape) - sensor_conn).astype(int)
+    ####### Create array for distances between sensors #########
 
-print('Creaing datasets...')
+    # Find distances (miles) for all pairs of sensors, streamed straight to disk. Connectivity
+    # between sensors is not stored, the graphs derive it from Freeway and Direction
+    n_sensor = len(vds_info)
+    sensor_dist = np.lib.format.open_memmap('sensor_dist.npy', mode='w+', dtype=np.float64, shape=(n_sensor, n_sensor))
+    distance_matrix(vds_info['Lat'].values, vds_info['Lng'].values, out=sensor_dist)
+    sensor_dist.flush()
 
-sensor_speed.to_csv('sensor_speed.csv', index=True)
-vds_info.to_csv('vds_info_w_lanes.csv', index=True)
-sensor_dist.to_csv('sensor_dist.csv', index=True)
-sensor_conn.to_csv('sensor_conn.csv', index=True)
-non_conn.to_csv('non_conn.csv', index=True)
+    print('Done!')
 
-print('Done!')
\ No newline at end of file
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create the datasets used by the graphs')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of processes used to read sensor files (default: all cores)')
+    parser.add_argument('--append', action='store_true',
+                        help='only add new weeks to the existing datasets instead of rebuilding them')
+    args = parser.parse_args()
+    if args.append:
+        append(workers=args.workers)
+    else:
+        main(workers=args.workers)
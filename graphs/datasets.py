@@ -0,0 +1,376 @@
+# Datasets of sliding windows over the sensor speeds
+#
+# The z-scored speeds of all sensors are kept once as a (n_time, n_sensor) tensor. The graph
+# of a window is only built when it is indexed: x and y are views into the speed tensor and
+# the edges are shared by every window, so the dataset takes no more memory than the speeds.
+#
+# The z-scored speeds are cached once in data/processed under a key made from the
+# fingerprint of the input datasets and the normalization, and shared by every graph. The
+# edges and features of a graph are cached next to them under a key that also covers the
+# window config and the edges. Both keys include the source of this module. Later runs
+# memory-map the cached speeds instead of processing again, and any change to the data,
+# parameters or processing gives a new key.
+
+import copy
+import hashlib
+import json
+import math
+import os
+import sys
+import numpy as np
+import torch
+from torch_geometric.data import Dataset, Data, HeteroData
+
+from graphs.edges import corridor_partition, edge_partition
+from graphs.loaders import data_directory
+from graphs.stages import source_hash
+
+# Config entries that change the processed tensors. Edge thresholds are covered by hashing
+# the edges themselves
+WINDOW_CONFIG = ['N_HIST', 'N_PRED', 'N_DAYS', 'N_DAY_SLOT', 'N_SLOT']
+
+def z_score(x, mean, std):
+    return (x - mean) / std
+
+def calendar_features(times):
+    """Features of each time, computed once for the whole time index.
+
+    Returns an (n_time, 9) float32 tensor: the day of week one hot encoded (Monday first),
+    then the sine and cosine of the hour of day.
+    """
+    times = np.asarray(times, dtype='datetime64[m]')
+    days = times.astype('datetime64[D]')
+
+    # 1970-01-01 was a Thursday
+    day_of_week = (days.astype(np.int64) + 3) % 7
+    day_one_hot = np.eye(7)[day_of_week]
+
+    # Normalize the hour to a value between 0 and 2pi
+    hour = (times - days).astype('timedelta64[h]').astype(np.int64)
+    normalized_hour = (hour / 24.0) * 2 * np.pi
+    hour_sin_cos = np.stack([np.sin(normalized_hour), np.cos(normalized_hour)], axis=1)
+
+    return torch.as_tensor(np.concatenate([day_one_hot, hour_sin_cos], axis=1), dtype=torch.float32)
+
+def cache_key(fingerprint, *inputs):
+    # Hash of the code and of everything that goes into a processed file, except the speeds
+    # which are identified by the fingerprint
+    key = hashlib.sha1()
+    key.update(source_hash(sys.modules[__name__]).encode())
+    key.update(fingerprint.encode())
+
+    def update(value):
+        if isinstance(value, dict):
+            for name in sorted(value):
+                key.update(name.encode())
+                update(value[name])
+        elif isinstance(value, (tuple, list)):
+            for item in value:
+                update(item)
+        elif isinstance(value, torch.Tensor):
+            key.update(str(value.dtype).encode() + str(tuple(value.shape)).encode())
+            key.update(value.contiguous().numpy().tobytes())
+        else:
+            key.update(repr(value).encode())
+
+    for value in inputs:
+        update(value)
+    return key.hexdigest()[:16]
+
+def expand_features(x, static, calendar):
+    """Append static and calendar features to the node features of a batch of windows.
+
+    x is (batch_size * n_node, n_feature), static is (batch_size * n_node, n_static), the
+    static features of every node of the batch, and calendar is (batch_size, n_calendar).
+    Each window's calendar row is repeated for all of its nodes.
+    """
+    batch_size = calendar.shape[0]
+    return torch.cat([
+        x,
+        static,
+        calendar.repeat_interleave(x.shape[0] // batch_size, dim=0)
+    ], dim=1)
+
+def save_processed(processed, path):
+    # Written under a temporary name and renamed, so other processes never read a partial file
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    torch.save(processed, tmp_path)
+    os.replace(tmp_path, path)
+
+def tile_edges(edges, n_node, batch_size):
+    # Edges of batch_size disjoint copies of a graph, nodes of copy i offset by i * n_node
+    def tile(edge_index, edge_attr):
+        offset = torch.arange(batch_size).repeat_interleave(edge_index.shape[1]) * n_node
+        return edge_index.repeat(1, batch_size) + offset, edge_attr.repeat(batch_size, 1)
+
+    if isinstance(edges, dict):
+        return {edge_type: tile(*edges[edge_type]) for edge_type in edges}
+    return tile(*edges)
+
+class SpeedWindows(Dataset):
+    """Windows of N_HIST + N_PRED speeds for every sensor, N_SLOT windows per day.
+
+    `edges` is the (edge_index, edge_attr) pair of a graph with a single edge type, or a
+    dict from edge type name to (edge_index, edge_attr) for a graph with typed edges, in
+    which case windows are HeteroData with the sensors as the 'sensor' node type.
+
+    Features that do not change over time are kept once in `static` (n_node, n_static), and
+    windows get the rows of their nodes as `static`. They are data and not part of the models,
+    so a model runs on any set of sensors that has them. With a `calendar` table (see
+    calendar_features) each window gets the (1, n_calendar) row of its last past speed as
+    `calendar`. Models add both to the features of the nodes of a batch with expand_features.
+
+    `fingerprint` identifies the input data (see loaders.data_fingerprint). The speeds are
+    cached under it and the normalization, the rest together with the window config and
+    the edges as well.
+    """
+    def __init__(self, config, speed, mean, std_dev, edges, static=None, calendar=None,
+                 fingerprint='', root=None, transform=None):
+        self.config = dict(config)
+        self.inputs = {'speed': speed, 'mean': mean, 'std_dev': std_dev, 'edges': edges,
+                       'static': static, 'calendar': calendar}
+        self.speed_key = cache_key(fingerprint, mean, std_dev)
+        self.key = cache_key(fingerprint, json.dumps({name: config[name] for name in WINDOW_CONFIG}, sort_keys=True),
+                             mean, std_dev, edges, static, calendar)
+        super().__init__(root or data_directory, transform)
+
+        # Processed or not, always load from the cache so the speeds are memory-mapped
+        self.inputs = None
+        self.speed = torch.load(self.processed_paths[0], mmap=True)['speed']
+        processed = torch.load(self.processed_paths[1], mmap=True)
+        self.edges = processed['edges']
+        self.static = processed['static']
+        self.calendar = processed['calendar']
+        self.n_node, self.mean, self.std_dev = processed['n_node'], processed['mean'], processed['std_dev']
+
+    @property
+    def processed_file_names(self):
+        return [f'speeds_{self.speed_key}.pt', f'windows_{self.key}.pt']
+
+    def _process(self):
+        # Replaces torch_geometric's bookkeeping of pre_transform.pt and pre_filter.pt, which
+        # every dataset in data/processed would rewrite. Processed files are named by their key
+        # and written atomically, so processes running side by side (see run.py) can share them
+        if not all(os.path.exists(path) for path in self.processed_paths):
+            os.makedirs(self.processed_dir, exist_ok=True)
+            self.process()
+
+    def process(self):
+        speed_path, windows_path = self.processed_paths
+        mean, std_dev = self.inputs['mean'], self.inputs['std_dev']
+        speed = np.asarray(self.inputs['speed'], dtype=np.float32)
+
+        if not os.path.exists(speed_path):
+            # (n_time, n_sensor) z-scored speeds, the only copy of the data, shared by every graph
+            save_processed({'speed': torch.as_tensor(z_score(speed, mean, std_dev), dtype=torch.float32)}, speed_path)
+
+        if not os.path.exists(windows_path):
+            save_processed({
+                'edges': self.inputs['edges'],
+                'static': self.inputs['static'],
+                'calendar': self.inputs['calendar'],
+                'n_node': speed.shape[1],
+                'mean': mean,
+                'std_dev': std_dev
+            }, windows_path)
+
+    def horizon(self, n_pred):
+        """View of the dataset that predicts the next n_pred speeds, sharing all tensors.
+
+        n_pred can be at most the N_PRED the dataset was built with. Windows stay within a
+        day, so shorter horizons have more windows (N_SLOT) per day.
+        """
+        if n_pred > self.config['N_PRED']:
+            raise ValueError(f"Dataset was built for at most {self.config['N_PRED']} predictions, not {n_pred}")
+
+        view = copy.copy(self)
+        view.config = dict(self.config, N_PRED=n_pred)
+        view.config['N_SLOT'] = view.config['N_DAY_SLOT'] - (n_pred + view.config['N_HIST']) + 1
+        view._indices = None
+        return view
+
+    def len(self):
+        return self.config['N_DAYS'] * self.config['N_SLOT']
+
+    def window_start(self, idx):
+        # Time index of the first speed in a window, windows do not cross days. Works on ints
+        # and on tensors of window indices
+        day, slot = idx // self.config['N_SLOT'], idx % self.config['N_SLOT']
+        return day * self.config['N_DAY_SLOT'] + slot
+
+    def graph(self, x, y, edges, static, calendar, num_nodes):
+        # Data or HeteroData object holding one window or a batch of windows
+        if isinstance(edges, dict):
+            g = HeteroData()
+            for edge_type, (edge_index, edge_attr) in edges.items():
+                g['sensor', edge_type, 'sensor'].edge_index = edge_index
+                g['sensor', edge_type, 'sensor'].edge_attr = edge_attr
+            g['sensor'].x = x
+            g['sensor'].y = y
+        else:
+            edge_index, edge_attr = edges
+            g = Data(x=x, y=y, edge_index=edge_index, edge_attr=edge_attr, num_nodes=num_nodes)
+
+        if static is not None:
+            g.static = static
+        if calendar is not None:
+            g.calendar = calendar
+        return g
+
+    def get(self, idx):
+        sta = self.window_start(idx)
+        end = sta + self.config['N_HIST'] + self.config['N_PRED']
+
+        # (T,N) switched to (N,T) without copying
+        window = self.speed[sta:end].T
+        x = window[:, :self.config['N_HIST']]
+        y = window[:, self.config['N_HIST']:]
+
+        calendar = None
+        if self.calendar is not None:
+            last = sta + self.config['N_HIST'] - 1
+            calendar = self.calendar[last:last+1]
+        return self.graph(x, y, self.edges, self.static, calendar, self.n_node)
+
+    def batch(self, idx, edges, nodes=None, n_core=None):
+        """Gather the windows in the tensor idx into one graph of len(idx) disjoint windows.
+
+        `edges` must already be tiled for len(idx) windows (see WindowLoader). x and y are
+        gathered from the speeds as dense (batch_size, n_node, T) tensors in one indexing
+        operation and flattened to (batch_size * n_node, T) like a collated batch.
+
+        With `nodes`, windows only hold those sensors (a subgraph, see SubgraphLoader) and y
+        only the first n_core of them. The batch then has the sensor of every node as `n_id`
+        and `core_mask`, True for the nodes that have a y. `static` holds the static features
+        of every node of the batch.
+        """
+        batch_size = len(idx)
+        starts = self.window_start(idx)
+        steps = torch.arange(self.config['N_HIST'] + self.config['N_PRED'])
+
+        # (B, T, N) -> (B, N, T)
+        if nodes is None:
+            window = self.speed[starts[:, None] + steps].transpose(1, 2)
+        else:
+            window = self.speed[(starts[:, None] + steps)[:, :, None], nodes].transpose(1, 2)
+        x = window[:, :, :self.config['N_HIST']].reshape(-1, self.config['N_HIST'])
+        y = window[:, :n_core, self.config['N_HIST']:].reshape(-1, self.config['N_PRED'])
+
+        calendar = None
+        if self.calendar is not None:
+            calendar = self.calendar[starts + self.config['N_HIST'] - 1]
+
+        static = None
+        if self.static is not None:
+            static = (self.static if nodes is None else self.static[nodes]).repeat(batch_size, 1)
+
+        g = self.graph(x, y, edges, static, calendar, batch_size * window.shape[1])
+        g.num_graphs = batch_size
+        if nodes is not None:
+            g.n_id = nodes.repeat(batch_size)
+            g.core_mask = (torch.arange(len(nodes)) < n_core).repeat(batch_size)
+        return g
+
+class WindowLoader:
+    """Batches of windows for the ST-GAT models, a drop in for torch_geometric's DataLoader.
+
+    Every window has the same graph, so instead of collating windows one by one each batch
+    is gathered straight from the speed tensor (SpeedWindows.batch). The edge index of
+    batch_size copies of the graph is tiled once per batch size and reused.
+    """
+    def __init__(self, dataset, batch_size=1, shuffle=False):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.tiled_edges = {}
+
+    def __len__(self):
+        return math.ceil(len(self.dataset) / self.batch_size)
+
+    def tile_edges(self, batch_size):
+        if batch_size not in self.tiled_edges:
+            self.tiled_edges[batch_size] = tile_edges(self.dataset.edges, self.dataset.n_node, batch_size)
+        return self.tiled_edges[batch_size]
+
+    def window_batches(self):
+        # Tensors of the window indices in each batch
+        windows = torch.as_tensor(list(self.dataset.indices()), dtype=torch.long)
+        order = torch.randperm(len(windows)) if self.shuffle else torch.arange(len(windows))
+        return [windows[order[sta:sta + self.batch_size]] for sta in range(0, len(windows), self.batch_size)]
+
+    def __iter__(self):
+        for idx in self.window_batches():
+            yield self.dataset.batch(idx, self.tile_edges(len(idx)))
+
+class SubgraphLoader(WindowLoader):
+    """Batches of windows on parts of the sensor graph, for training on large networks.
+
+    `parts` gives the part of every sensor (see edges.corridor_partition and
+    edges.edge_partition). Each batch holds batch_size windows of one part and its halo, the
+    sensors with an edge into the part that the GAT layer reads from. Only the part's own
+    sensors have a y (see SpeedWindows.batch), so memory per batch depends on the part size
+    and not on the size of the network. Every window batch is seen once per part in an epoch.
+    """
+    def __init__(self, dataset, parts, batch_size=1, shuffle=False):
+        super().__init__(dataset, batch_size, shuffle)
+        parts = torch.as_tensor(np.asarray(parts), dtype=torch.long)
+        self.subgraphs = [self.subgraph(torch.nonzero(parts == part).flatten()) for part in torch.unique(parts)]
+
+    def __len__(self):
+        return super().__len__() * len(self.subgraphs)
+
+    def subgraph(self, core):
+        # Sensors of a part followed by its halo, and the edges into the part between them
+        edges = self.dataset.edges
+        edge_sets = edges.values() if isinstance(edges, dict) else [edges]
+        in_core = torch.zeros(self.dataset.n_node, dtype=torch.bool)
+        in_core[core] = True
+
+        sources = torch.cat([edge_index[0, in_core[edge_index[1]]] for edge_index, _ in edge_sets])
+        halo = torch.unique(sources[~in_core[sources]])
+        nodes = torch.cat([core, halo])
+        local = torch.full((self.dataset.n_node,), -1, dtype=torch.long)
+        local[nodes] = torch.arange(len(nodes))
+
+        def select(edge_index, edge_attr):
+            keep = in_core[edge_index[1]]
+            return local[edge_index[:, keep]], edge_attr[keep]
+
+        if isinstance(edges, dict):
+            edges = {edge_type: select(*edges[edge_type]) for edge_type in edges}
+        else:
+            edges = select(*edges)
+        return {'nodes': nodes, 'n_core': len(core), 'edges': edges, 'tiled_edges': {}}
+
+    def __iter__(self):
+        batches = [(idx, subgraph) for idx in self.window_batches() for subgraph in self.subgraphs]
+        order = torch.randperm(len(batches)) if self.shuffle else torch.arange(len(batches))
+        for i in order.tolist():
+            idx, subgraph = batches[i]
+            if len(idx) not in subgraph['tiled_edges']:
+                subgraph['tiled_edges'][len(idx)] = tile_edges(subgraph['edges'], len(subgraph['nodes']), len(idx))
+            yield self.dataset.batch(idx, subgraph['tiled_edges'][len(idx)], subgraph['nodes'], subgraph['n_core'])
+
+def subgraph_batches(dataloader, groups, config):
+    """Training batches on parts of at most SUBGRAPH_SIZE sensors (see SubgraphLoader), or
+    the dataloader itself when SUBGRAPH_SIZE is None.
+
+    SUBGRAPH_PARTITION splits the sensors along each 'corridor' (freeway and direction) or
+    over the 'edges' of all types. Only models that do not depend on the number of nodes
+    (NODE_TEMPORAL) can be trained on parts of the network.
+    """
+    if config['SUBGRAPH_SIZE'] is None:
+        return dataloader
+    if not config['NODE_TEMPORAL']:
+        raise ValueError('Training on subgraphs needs NODE_TEMPORAL, other models only fit the whole network')
+
+    dataset = dataloader.dataset
+    if config['SUBGRAPH_PARTITION'] == 'corridor':
+        parts = corridor_partition(groups, config['SUBGRAPH_SIZE'])
+    elif config['SUBGRAPH_PARTITION'] == 'edges':
+        edges = dataset.edges.values() if isinstance(dataset.edges, dict) else [dataset.edges]
+        edge_index = torch.cat([edge_index for edge_index, _ in edges], dim=1)
+        parts = edge_partition(edge_index.numpy(), dataset.n_node, config['SUBGRAPH_SIZE'])
+    else:
+        raise ValueError(f"Unknown SUBGRAPH_PARTITION {config['SUBGRAPH_PARTITION']!r}, expected 'corridor' or 'edges'")
+    return SubgraphLoader(dataset, parts, batch_size=dataloader.batch_size, shuffle=dataloader.shuffle)
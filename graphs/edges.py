@@ -0,0 +1,306 @@
+# Edge construction shared by all graphs
+#
+# Connectivity is represented by one group id per sensor (see loaders.load_sensor_groups):
+# two sensors are connected when they are on the same freeway and direction. Builders
+# compare the group ids of the pairs of sensors they consider, no mask over all pairs of
+# sensors is built.
+#
+# Builders return a dense (n_sensor, n_sensor) weight matrix W, or with sparse=True an
+# edge list (edge_index, edge_weight): a (2, n_edge) int64 array of (source, target)
+# sensors sorted by source then target, and the weight of each edge.
+
+from collections import deque
+import numpy as np
+import torch
+
+from graphs.spatial_index import SensorIndex
+
+def symmetric_edges(src, dst, weight, n_node):
+    # Union of the edges and their reverse, keeping the largest weight of duplicate edges
+    src, dst = np.concatenate([src, dst]), np.concatenate([dst, src])
+    weight = np.concatenate([weight, weight])
+
+    key = src.astype(np.int64) * n_node + dst
+    order = np.argsort(key, kind='stable')
+    key, weight = key[order], weight[order]
+    if len(key):
+        first = np.flatnonzero(np.r_[True, key[1:] != key[:-1]])
+        key, weight = key[first], np.maximum.reduceat(weight, first)
+    return np.stack([key // n_node, key % n_node]), weight
+
+def edges_to_dense(edge_index, edge_weight, n_node):
+    W = np.zeros((n_node, n_node))
+    W[edge_index[0], edge_index[1]] = edge_weight
+    return W
+
+def dense_to_edges(W):
+    # Edge list of the nonzero entries of a weight matrix, in row major order
+    W = np.asarray(W)
+    edge_index = np.stack(np.nonzero(W))
+    return edge_index, W[edge_index[0], edge_index[1]]
+
+def add_edges(*Ws):
+    """Sum of weight matrices given as dense matrices or edge lists.
+
+    Returns a dense matrix if all of them are dense, otherwise an edge list with the
+    weights of duplicate edges summed.
+    """
+    if not any(isinstance(W, tuple) for W in Ws):
+        return sum(Ws)
+
+    edges = [W if isinstance(W, tuple) else dense_to_edges(W) for W in Ws]
+    edge_index = np.concatenate([edge_index for edge_index, _ in edges], axis=1)
+    edge_weight = np.concatenate([edge_weight for _, edge_weight in edges])
+
+    edge_index, inverse = np.unique(edge_index, axis=1, return_inverse=True)
+    return edge_index, np.bincount(inverse.reshape(-1), weights=edge_weight, minlength=edge_index.shape[1])
+
+def to_edge_index(W):
+    """Convert a weight matrix or an edge list to the edge_index and edge_attr of a graph.
+
+    Returns a (2, n_edge) long tensor and an (n_edge, 1) float tensor, with edges in row
+    major order.
+    """
+    if isinstance(W, tuple):
+        edge_index, edge_weight = W
+    else:
+        edge_index, edge_weight = dense_to_edges(W)
+    edge_index = torch.as_tensor(np.asarray(edge_index), dtype=torch.long)
+    edge_attr = torch.as_tensor(np.asarray(edge_weight), dtype=torch.float32).reshape(-1, 1)
+    return edge_index, edge_attr
+
+def closest_per_row(src, dst, dist, k):
+    # Keep the k closest targets of every source, plus any tied with the k-th closest
+    order = np.lexsort((dist, src))
+    src, dst, dist = src[order], dst[order], dist[order]
+
+    row_start = np.searchsorted(src, src)
+    row_end = np.searchsorted(src, src, side='right')
+    kth = np.where(row_end - row_start > k, dist[np.minimum(row_start + k - 1, len(dist) - 1)], np.inf)
+    keep = dist <= kth
+    return src[keep], dst[keep], dist[keep]
+
+def pair_distance(dist, src, dst):
+    # Distances between pairs of sensors from a distance matrix or a SensorIndex
+    if isinstance(dist, SensorIndex):
+        return dist.distance(src, dst)
+    return np.asarray(dist[src, dst], dtype=np.float64)
+
+def axis_position(lat, lng, groups):
+    """Position of each sensor along a straight line fitted through its group.
+
+    Only needed when the sensors are not already listed in order along the road, the
+    rows of vds_info are.
+    """
+    points = np.stack([np.asarray(lat, dtype=np.float64), np.asarray(lng, dtype=np.float64)], axis=1)
+    groups = np.asarray(groups)
+    position = np.zeros(len(points))
+    for group in np.unique(groups):
+        members = groups == group
+        centered = points[members] - points[members].mean(axis=0)
+        # Principal axis of the group's coordinates
+        _, _, vt = np.linalg.svd(centered, full_matrices=False)
+        position[members] = centered @ vt[0]
+    return position
+
+def corridor_order(groups, position=None):
+    """Sensors sorted by group, then along the corridor.
+
+    `position` is any per sensor value that increases along the road (e.g. from
+    axis_position). By default sensors keep their row order within a group.
+    """
+    groups = np.asarray(groups)
+    if position is None:
+        return np.argsort(groups, kind='stable')
+    return np.lexsort((position, groups))
+
+def corridor_partition(groups, max_size, position=None):
+    """Split every group into parts of at most max_size consecutive sensors along its corridor.
+
+    Returns the part of every sensor. Parts of a group are about the same size and never
+    span two groups.
+    """
+    groups = np.asarray(groups)
+    order = corridor_order(groups, position)
+    sorted_groups = groups[order]
+    group_start = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+    group_size = np.diff(np.r_[group_start, len(groups)])
+
+    # Sensor j of a group of size s split into n parts goes to part j * n // s of the group
+    n_parts = -(-group_size // max_size)
+    first_part = np.r_[0, np.cumsum(n_parts)[:-1]]
+    group = np.repeat(np.arange(len(group_start)), group_size)
+    rank = np.arange(len(groups)) - group_start[group]
+
+    part = np.empty(len(groups), dtype=np.int64)
+    part[order] = first_part[group] + rank * n_parts[group] // group_size[group]
+    return part
+
+def edge_partition(edge_index, n_node, max_size):
+    """Split the sensors into parts of at most max_size sensors connected by edges.
+
+    Parts are grown breadth first from the first unassigned sensor over edges of any type in
+    either direction, so sensors of different groups joined by type 2 edges can share a part.
+    Returns the part of every sensor.
+    """
+    src = np.concatenate([edge_index[0], edge_index[1]])
+    dst = np.concatenate([edge_index[1], edge_index[0]])
+    order = np.argsort(src, kind='stable')
+    neighbors = dst[order]
+    neighbor_start = np.searchsorted(src[order], np.arange(n_node + 1))
+
+    part = np.full(n_node, -1, dtype=np.int64)
+    n_part = 0
+    for seed in range(n_node):
+        if part[seed] >= 0:
+            continue
+        part[seed] = n_part
+        size = 1
+        queue = deque([seed])
+        while queue and size < max_size:
+            node = queue.popleft()
+            for neighbor in neighbors[neighbor_start[node]:neighbor_start[node + 1]]:
+                if part[neighbor] < 0 and size < max_size:
+                    part[neighbor] = n_part
+                    size += 1
+                    queue.append(neighbor)
+        n_part += 1
+    return part
+
+def distance_to_W1(dist, groups, position=None, sparse=False):
+    """Type 1 edges: each sensor and the next sensor along the same freeway and direction.
+
+    `dist` is a distance matrix or a SensorIndex, only distances between consecutive
+    sensors are looked up.
+    """
+    groups = np.asarray(groups)
+    n_node = len(groups)
+    order = corridor_order(groups, position)
+
+    # Step from each sensor to the next one along the corridor, 0 at the end of a group
+    same_group = np.r_[groups[order[:-1]] == groups[order[1:]], False]
+    step = np.zeros(n_node)
+    step[same_group] = pair_distance(dist, order[same_group], order[np.flatnonzero(same_group) + 1])
+
+    # Sensors sharing a location with the next one skip past it, so each sensor links to
+    # the first sensor after the end of its run of shared locations
+    run_end = np.flatnonzero((step > 0) | ~same_group)
+    nearest = run_end[np.searchsorted(run_end, np.arange(n_node))]
+    has_next = step[nearest] > 0
+
+    src = order[has_next]
+    dst = order[nearest[has_next] + 1]
+    weight = 1 / pair_distance(dist, src, dst)
+
+    edge_index, edge_weight = symmetric_edges(src, dst, weight, n_node)
+    if sparse:
+        return edge_index, edge_weight
+    return edges_to_dense(edge_index, edge_weight, n_node)
+
+# Number of rows of the distance matrix searched at once by distance_to_W2 and W3
+W2_BLOCK_SIZE = 1024
+
+def index_to_W2(index, groups, dist_thresh, edge_num_thresh):
+    # Type 2 edges from a spatial index, only sensors within dist_thresh are ever compared
+    groups = np.asarray(groups)
+    src, dst, dist = index.query_radius(dist_thresh)
+
+    # Mask with directional nonconnectivity
+    keep = (groups[src] != groups[dst]) & (dist > 0)
+    src, dst, dist = src[keep], dst[keep], dist[keep]
+
+    if edge_num_thresh <= 0:
+        src, dst, dist = src[:0], dst[:0], dist[:0]
+    else:
+        src, dst, dist = closest_per_row(src, dst, dist, edge_num_thresh)
+
+    return symmetric_edges(src, dst, 1 / dist, len(index))
+
+def distance_to_W2(dist, groups, dist_thresh, edge_num_thresh, sparse=False):
+    """Type 2 edges: the edge_num_thresh closest sensors within dist_thresh miles on other
+    freeways or directions, made symmetric.
+
+    `dist` is a distance matrix, or a SensorIndex to avoid computing distances between all
+    pairs of sensors.
+    """
+    if isinstance(dist, SensorIndex):
+        edge_index, edge_weight = index_to_W2(dist, groups, dist_thresh, edge_num_thresh)
+        if sparse:
+            return edge_index, edge_weight
+        return edges_to_dense(edge_index, edge_weight, len(dist))
+
+    groups = np.asarray(groups)
+    n_node = len(groups)
+    k = min(edge_num_thresh, n_node)
+    src, dst, pair_dist = [], [], []
+    for sta in range(0, n_node, W2_BLOCK_SIZE):
+        end = min(sta + W2_BLOCK_SIZE, n_node)
+        block = np.array(dist[sta:end], dtype=np.float64)
+
+        # Mask with directional nonconnectivity and the distance threshold
+        candidate = (groups[sta:end, None] != groups[None, :]) & (block > 0) & (block <= dist_thresh)
+        block[~candidate] = np.inf
+        if k <= 0:
+            continue
+
+        # Distance of the k-th closest candidate of each row, anything tied with it is kept
+        kth = np.partition(block, k - 1, axis=1)[:, k - 1]
+        rows, cols = np.nonzero(candidate & (block <= kth[:, None]))
+        src.append(rows + sta)
+        dst.append(cols)
+        pair_dist.append(block[rows, cols])
+
+    src = np.concatenate(src) if src else np.zeros(0, dtype=np.int64)
+    dst = np.concatenate(dst) if dst else np.zeros(0, dtype=np.int64)
+    pair_dist = np.concatenate(pair_dist) if pair_dist else np.zeros(0)
+
+    edge_index, edge_weight = symmetric_edges(src, dst, 1 / pair_dist, n_node)
+    if sparse:
+        return edge_index, edge_weight
+    return edges_to_dense(edge_index, edge_weight, n_node)
+
+def corridor_rank(groups, position=None):
+    # Position of each sensor in corridor_order. Within a group, the difference between two
+    # ranks is the number of hops along the corridor
+    order = corridor_order(groups, position)
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    return rank
+
+def pairs_within(dist, radius):
+    # All ordered pairs of distinct sensors at most `radius` miles apart, as (src, dst, dist)
+    if isinstance(dist, SensorIndex):
+        return dist.query_radius(radius)
+
+    n_node = len(dist)
+    src, dst, pair_dist = [], [], []
+    for sta in range(0, n_node, W2_BLOCK_SIZE):
+        block = np.asarray(dist[sta:sta + W2_BLOCK_SIZE], dtype=np.float64)
+        rows, cols = np.nonzero(block <= radius)
+        not_self = rows + sta != cols
+        src.append(rows[not_self] + sta)
+        dst.append(cols[not_self])
+        pair_dist.append(block[rows[not_self], cols[not_self]])
+
+    return np.concatenate(src), np.concatenate(dst), np.concatenate(pair_dist)
+
+def distance_to_W3(dist, groups, nth_jump, jump_dist_thresh, position=None, sparse=False):
+    """Type 3 edges: each sensor and every nth_jump-th sensor after it along the same freeway
+    and direction (n, 2n, 3n, ... hops away) that is closer than jump_dist_thresh miles.
+
+    `dist` is a distance matrix or a SensorIndex, only pairs within jump_dist_thresh are
+    looked at.
+    """
+    groups = np.asarray(groups)
+    rank = corridor_rank(groups, position)
+    src, dst, pair_dist = pairs_within(dist, jump_dist_thresh)
+
+    hops = rank[dst] - rank[src]
+    keep = ((groups[src] == groups[dst]) & (hops > 0) & (hops % nth_jump == 0)
+            & (pair_dist > 0) & (pair_dist < jump_dist_thresh))
+    src, dst, pair_dist = src[keep], dst[keep], pair_dist[keep]
+
+    edge_index, edge_weight = symmetric_edges(src, dst, 1 / pair_dist, len(groups))
+    if sparse:
+        return edge_index, edge_weight
+    return edges_to_dense(edge_index, edge_weight, len(groups))
@@ -0,0 +1,83 @@
+# Loaders for the datasets written by data/create_datasets.py
+#
+# Speeds and distances are stored as .npy files and memory-mapped, so loading them costs
+# no parsing and only the parts that are touched are read from disk.
+#
+# Each input is loaded once per process and the same read-only object is returned to every
+# graph. Processes forked after preload() share the inputs of their parent.
+
+import os
+import json
+import hashlib
+import functools
+import numpy as np
+import pandas as pd
+
+data_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+
+def data_path(file):
+    return os.path.join(data_directory, file)
+
+@functools.lru_cache(maxsize=None)
+def load_vds_info():
+    # Sensor info, one row per sensor in the same order as the columns of sensor_speed
+    return pd.read_csv(data_path('vds_info_w_lanes.csv')).set_index('vds_id')
+
+@functools.lru_cache(maxsize=None)
+def load_sensor_speed():
+    """Load speeds as a read-only memory-mapped (n_time, n_sensor) float32 array.
+
+    Also returns the time of each row as a datetime64 array.
+    """
+    sensor_speed = np.load(data_path('sensor_speed.npy'), mmap_mode='r')
+    sensor_times = np.load(data_path('sensor_times.npy'))
+    return sensor_speed, sensor_times
+
+@functools.lru_cache(maxsize=None)
+def load_sensor_speed_stats():
+    # Mean and standard deviation of all speeds, kept up to date when weeks are appended
+    with open(data_path('sensor_speed.json')) as f:
+        meta = json.load(f)
+    return meta['mean'], meta['std']
+
+@functools.lru_cache(maxsize=None)
+def load_sensor_dist():
+    # (n_sensor, n_sensor) distances in miles
+    return np.load(data_path('sensor_dist.npy'), mmap_mode='r')
+
+@functools.lru_cache(maxsize=None)
+def load_sensor_groups():
+    """Group id of each sensor, in the order of load_vds_info.
+
+    Sensors on the same freeway and direction share a group. This is all the connectivity
+    information the graphs need, see graphs/edges.py.
+    """
+    vds_info = load_vds_info()
+    groups, _ = pd.factorize(vds_info['Freeway'] + vds_info['Direction'])
+    return groups
+
+@functools.lru_cache(maxsize=None)
+def data_fingerprint():
+    """Short hash that changes whenever create_datasets.py rebuilds or appends to the datasets.
+
+    Metadata and sensor info are hashed by content, the .npy files by size and modification
+    time so they do not have to be read.
+    """
+    fingerprint = hashlib.sha1()
+    for file in ['sensor_speed.json', 'vds_info_w_lanes.csv']:
+        with open(data_path(file), 'rb') as f:
+            fingerprint.update(f.read())
+    for file in ['sensor_speed.npy', 'sensor_times.npy']:
+        stat = os.stat(data_path(file))
+        fingerprint.update(f'{file}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    return fingerprint.hexdigest()[:16]
+
+def preload():
+    """Load every input, so processes forked afterwards (see run.py) share them instead of
+    loading their own copies."""
+    load_vds_info()
+    load_sensor_speed()
+    load_sensor_speed_stats()
+    load_sensor_dist()
+    load_sensor_groups()
+    data_fingerprint()
@@ -0,0 +1,134 @@
+# Metrics of the predictions of the graphs, and the sink the training metrics are written to
+
+import os
+import csv
+import json
+import threading
+import torch
+
+class StreamingMetrics:
+    """Running sums of the squared, absolute and absolute percentage errors for each sensor
+    and each predicted step, kept on the device of the predictions.
+
+    Batches are added with update and the metrics computed once at the end, so every window
+    counts the same however the windows are split into batches and nothing is copied to the
+    host until compute is read.
+    """
+    def __init__(self, n_node):
+        self.n_node = n_node
+        # (3, n_node, n_pred) sums of squared, absolute and absolute percentage errors
+        self.sums = None
+        self.count = 0
+
+    def update(self, truth, pred):
+        # truth and pred are (n_window*n_node, n_pred) speeds, sensors of each window in order
+        error = (pred - truth).view(-1, self.n_node, pred.shape[-1])
+        truth = truth.view_as(error)
+        if self.sums is None:
+            self.sums = torch.zeros(3, self.n_node, pred.shape[-1], device=pred.device)
+        self.sums[0] += error.square().sum(0)
+        self.sums[1] += error.abs().sum(0)
+        self.sums[2] += (error.abs() / (truth + 1e-15) * 100).sum(0)
+        self.count += error.shape[0]
+
+    def compute(self, by=None):
+        """RMSE, MAE and MAPE over all predictions, as tensors on the device.
+
+        With by='step' they are (n_pred,) tensors, one value per predicted step, and with
+        by='sensor' (n_node,) tensors, one value per sensor.
+        """
+        dims = {None: (1, 2), 'step': 1, 'sensor': 2}[by]
+        sums = self.sums.sum(dims)
+        mean = sums / (self.count * self.sums[0].numel() / sums[0].numel())
+        return mean[0].sqrt(), mean[1], mean[2]
+
+class MetricsSink:
+    """Buffered writer of training metrics.
+
+    add only keeps the value, tensors stay on their device and nothing waits for them. A
+    background thread writes what was added every flush_interval seconds: the tensors are
+    copied to the host together, and a {name, epoch, step, value} record for each value is
+    appended to metrics.jsonl or metrics.csv (`format`) in `directory`, and with tensorboard
+    also written as TensorBoard events there.
+
+    Use it as a context manager, or call close, to write what is left and stop the thread.
+    """
+    def __init__(self, directory, flush_interval=10, format='jsonl', tensorboard=False):
+        if format not in ['jsonl', 'csv']:
+            raise ValueError(f"Unknown metrics format {format}, choose from jsonl, csv")
+        os.makedirs(directory, exist_ok=True)
+        self.flush_interval = flush_interval
+        self.file = open(os.path.join(directory, f'metrics.{format}'), 'a', newline='')
+        self.csv = None
+        if format == 'csv':
+            self.csv = csv.writer(self.file)
+            if self.file.tell() == 0:
+                self.csv.writerow(['name', 'epoch', 'step', 'value'])
+        self.writer = None
+        if tensorboard:
+            # Only needed when TensorBoard events are written
+            from torch.utils.tensorboard import SummaryWriter
+            self.writer = SummaryWriter(directory)
+
+        # Records added since the last flush. Flushes from the thread and from close do not
+        # interleave, so records are written in the order they were added
+        self.records = []
+        self.records_lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.flush_periodically, daemon=True)
+        self.thread.start()
+
+    def add(self, name, value, step, epoch=None):
+        if isinstance(value, torch.Tensor):
+            value = value.detach()
+        with self.records_lock:
+            self.records.append((name, epoch, step, value))
+
+    def flush(self):
+        with self.flush_lock:
+            with self.records_lock:
+                records, self.records = self.records, []
+            if not records:
+                return
+
+            # One transfer to the host for all the tensors on a device
+            values = [value for _, _, _, value in records]
+            on_device = {}
+            for i, value in enumerate(values):
+                if isinstance(value, torch.Tensor):
+                    on_device.setdefault(value.device, []).append(i)
+            for index in on_device.values():
+                host = torch.stack([values[i].reshape(()).float() for i in index]).tolist()
+                for i, value in zip(index, host):
+                    values[i] = value
+
+            for (name, epoch, step, _), value in zip(records, values):
+                value = float(value)
+                if self.csv is not None:
+                    self.csv.writerow([name, epoch, step, value])
+                else:
+                    self.file.write(json.dumps({'name': name, 'epoch': epoch, 'step': step, 'value': value}, separators=(',', ':')) + '\n')
+                if self.writer is not None:
+                    self.writer.add_scalar(name, value, step)
+            self.file.flush()
+            if self.writer is not None:
+                self.writer.flush()
+
+    def flush_periodically(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.flush()
+        self.file.close()
+        if self.writer is not None:
+            self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
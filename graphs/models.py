@@ -0,0 +1,167 @@
+# Building blocks shared by the ST-GAT models of all graphs
+
+import torch
+import torch.nn.functional as F
+from torch_geometric.nn.inits import glorot, zeros
+from torch_geometric.utils import softmax
+
+class LeadingSteps(torch.nn.Module):
+    """Wrap a model to return only the first n_pred steps of its predictions.
+
+    A model trained for the longest horizon is used this way for the shorter ones, the
+    predictions for the next 15 and 30 minutes are the leading steps of the 45 minute ones.
+    """
+    def __init__(self, model, n_pred):
+        super(LeadingSteps, self).__init__()
+        self.model = model
+        self.n_pred = n_pred
+
+    def forward(self, data, device):
+        return self.model(data, device)[:, :self.n_pred]
+
+class NodeTemporal(torch.nn.Module):
+    """LSTM encoder and linear decoder shared by all nodes.
+
+    The ST-GAT models read the GAT output of all sensors at once with an LSTM of
+    input_size=n_nodes and decode it with a linear layer to n_nodes * n_pred outputs, so their
+    size grows with the network and a trained model only fits the sensors it was trained on.
+    Here every node's GAT output is read as a sequence on its own by the same two LSTM layers,
+    and its last hidden state is decoded to its n_pred predictions. Parameters and compute per
+    node do not depend on the number of nodes, so one model runs on any network or subgraph.
+    """
+    def __init__(self, n_pred, lstm1_hidden_size=32, lstm2_hidden_size=64):
+        super(NodeTemporal, self).__init__()
+        self.lstm1 = torch.nn.LSTM(input_size=1, hidden_size=lstm1_hidden_size, num_layers=1)
+        self.lstm2 = torch.nn.LSTM(input_size=lstm1_hidden_size, hidden_size=lstm2_hidden_size, num_layers=1)
+        for lstm in (self.lstm1, self.lstm2):
+            for name, param in lstm.named_parameters():
+                if 'bias' in name:
+                    torch.nn.init.constant_(param, 0.0)
+                elif 'weight' in name:
+                    torch.nn.init.xavier_uniform_(param)
+
+        self.linear = torch.nn.Linear(lstm2_hidden_size, n_pred)
+        torch.nn.init.xavier_uniform_(self.linear.weight)
+
+    def forward(self, x):
+        # [batch_size*n_nodes, num_hist] -> [num_hist, batch_size*n_nodes, 1], every node is a
+        # sequence in the LSTM batch
+        x = x.T.unsqueeze(-1)
+        x, _ = self.lstm1(x)
+        x, _ = self.lstm2(x)
+
+        # Last hidden state of every node, [batch_size*n_nodes, lstm2_hidden_size] -> [batch_size*n_nodes, n_pred]
+        return self.linear(x[-1])
+
+def concat_edge_types(edge_index_dict):
+    """All edges of a graph with typed edges in one list.
+
+    Returns the (2, n_edge) edge index and the type of every edge, numbered in the order of
+    edge_index_dict.
+    """
+    edge_index = torch.cat(list(edge_index_dict.values()), dim=1)
+    edge_type = torch.cat([
+        torch.full((index.shape[1],), edge_type, dtype=torch.long, device=index.device)
+        for edge_type, index in enumerate(edge_index_dict.values())
+    ])
+    return edge_index, edge_type
+
+class TypedGATv2Conv(torch.nn.Module):
+    """GATv2 attention over several edge types in a single message passing pass.
+
+    Computes the same as HeteroConv({type: GATv2Conv(in_channels, out_channels, heads,
+    concat=False)}, aggr='sum') on one node type, but from one edge list and an edge_type
+    vector instead of one convolution per type. Every edge type has its own projections and
+    attention vector. Attention is normalized over the incoming edges of each node and type,
+    and each node gets one self loop of every type.
+
+    Self loops are computed densely on the nodes. The other edges are processed in blocks of
+    at most EDGE_BLOCK_SIZE edges of one type, which keeps per edge tensors small enough for
+    the memory allocator to reuse between batches.
+    """
+    EDGE_BLOCK_SIZE = 32768
+
+    def __init__(self, in_channels, out_channels, num_edge_types, heads=1, negative_slope=0.2):
+        super(TypedGATv2Conv, self).__init__()
+        self.in_channels = in_channels
+        self.out_channels = out_channels
+        self.num_edge_types = num_edge_types
+        self.heads = heads
+        self.negative_slope = negative_slope
+
+        # Per type weights of the source (l) and target (r) projections
+        self.lin_l = torch.nn.Parameter(torch.empty(num_edge_types, in_channels, heads * out_channels))
+        self.bias_l = torch.nn.Parameter(torch.empty(num_edge_types, heads * out_channels))
+        self.lin_r = torch.nn.Parameter(torch.empty(num_edge_types, in_channels, heads * out_channels))
+        self.bias_r = torch.nn.Parameter(torch.empty(num_edge_types, heads * out_channels))
+        self.att = torch.nn.Parameter(torch.empty(num_edge_types, heads, out_channels))
+        self.bias = torch.nn.Parameter(torch.empty(num_edge_types, out_channels))
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # Same initialization as GATv2Conv
+        glorot(self.lin_l)
+        glorot(self.lin_r)
+        glorot(self.att)
+        zeros(self.bias_l)
+        zeros(self.bias_r)
+        zeros(self.bias)
+
+    def edge_blocks(self, edge_type):
+        # (edge type, start, end) of consecutive blocks of edges sorted by type
+        type_end = torch.bincount(edge_type, minlength=self.num_edge_types).cumsum(0).tolist()
+        blocks = []
+        for t in range(self.num_edge_types):
+            type_sta = type_end[t - 1] if t else 0
+            for sta in range(type_sta, type_end[t], self.EDGE_BLOCK_SIZE):
+                blocks.append((t, sta, min(sta + self.EDGE_BLOCK_SIZE, type_end[t])))
+        return blocks
+
+    def forward(self, x, edge_index, edge_type):
+        n_node = x.shape[0]
+        n_type, heads, out_channels = self.num_edge_types, self.heads, self.out_channels
+
+        # Drop self loops, they are added densely below, and sort the other edges by type
+        keep = edge_index[0] != edge_index[1]
+        order = torch.argsort(edge_type[keep], stable=True)
+        src, dst, edge_type = edge_index[0, keep][order], edge_index[1, keep][order], edge_type[keep][order]
+        blocks = self.edge_blocks(edge_type)
+
+        # Attention vector of each type and head as a (heads * out_channels, heads) block
+        # diagonal matrix, so logits are a matmul
+        att = self.att.unsqueeze(-1) * torch.eye(heads, dtype=x.dtype, device=x.device).unsqueeze(1)
+        att = att.reshape(n_type, heads * out_channels, heads)
+
+        # Node projections of every type, (n_node, heads * out_channels) each
+        x_l = [torch.addmm(self.bias_l[t], x, self.lin_l[t]) for t in range(n_type)]
+        x_r = [torch.addmm(self.bias_r[t], x, self.lin_r[t]) for t in range(n_type)]
+
+        # Attention logits of the self loop of every node and type, then of the edges
+        alpha = [F.leaky_relu(x_r[t] + x_l[t], self.negative_slope, inplace=True) @ att[t] for t in range(n_type)]
+        x_j = []
+        for t, sta, end in blocks:
+            x_j.append(x_l[t].index_select(0, src[sta:end]))
+            e = x_r[t].index_select(0, dst[sta:end]).add_(x_j[-1])
+            alpha.append(F.leaky_relu(e, self.negative_slope, inplace=True) @ att[t])
+
+        # Normalize over the incoming edges of each node and type, self loop included
+        group = torch.cat([torch.arange(n_type * n_node, device=x.device), edge_type * n_node + dst])
+        alpha = softmax(torch.cat(alpha), group, num_nodes=n_type * n_node).unsqueeze(-1)
+
+        # Sum messages of all types, average the heads and add the bias of every type
+        alpha_loop, alpha = alpha[:n_type * n_node].view(n_type, n_node, heads, 1), alpha[n_type * n_node:]
+        out = sum(x_l[t].view(n_node, heads, out_channels) * alpha_loop[t] for t in range(n_type))
+        for (t, sta, end), x_block in zip(blocks, x_j):
+            out = out.index_add_(0, dst[sta:end], x_block.view(-1, heads, out_channels) * alpha[sta:end])
+        return out.mean(dim=1) + self.bias.sum(dim=0)
+
+    def load_hetero_conv(self, hetero_conv):
+        """Copy the weights of a HeteroConv of GATv2Convs, one per edge type in order."""
+        with torch.no_grad():
+            for edge_type, conv in enumerate(hetero_conv.convs.values()):
+                self.lin_l[edge_type] = conv.lin_l.weight.T
+                self.bias_l[edge_type] = conv.lin_l.bias
+                self.lin_r[edge_type] = conv.lin_r.weight.T
+                self.bias_r[edge_type] = conv.lin_r.bias
+                self.att[edge_type] = conv.att[0]
+                self.bias[edge_type] = conv.bias
@@ -0,0 +1,346 @@
+# Staged pipeline shared by the graphs
+#
+# Each graph module defines a GraphPipeline that runs the stages of its experiment in order:
+#
+#     load -> build_graph -> build_dataset -> train -> evaluate -> plot
+#
+# Importing a graph module runs none of them. Stages run when asked for and keep what they
+# produce on the pipeline, so a pipeline can stop after any stage, skip stages or be resumed:
+#
+#     from graphs.Graph6_EdgeType import GraphPipeline
+#     pipeline = GraphPipeline(EPOCHS=5)
+#     pipeline.run(until='build_graph')   # only the inputs and W1, W2 and W3
+#     pipeline.run(skip=['plot'])         # continues with the datasets, training and evaluation
+#     pipeline.run(horizons=[15])         # then only plots the predictions of the next 15 mins
+#     pipeline.results[15]                # (RMSE, MAE, MAPE) predicting the next 15 mins
+#
+# Underneath, the stages are a graph of smaller stages (see graphs/stages.py): one per
+# adjacency matrix, the datasets, and a model and its test results per horizon. Adjacency
+# matrices and trained models are cached in data/processed/stages by content, so they are
+# shared between graphs and reused by later runs. After changing the config, e.g.
+# pipeline.config['W3_NTH_JUMP'] = 4, running again only computes what depends on it.
+
+import os
+import inspect
+import torch
+import time
+from matplotlib.figure import Figure
+from graphs.loaders import load_vds_info, load_sensor_speed, load_sensor_speed_stats, load_sensor_dist, load_sensor_groups, data_fingerprint
+from graphs.spatial_index import SensorIndex
+from graphs.edges import distance_to_W1, distance_to_W2, distance_to_W3
+from graphs.datasets import WindowLoader
+from graphs.models import LeadingSteps
+from graphs.metrics import MetricsSink
+from graphs.stages import Stage, StageGraph
+
+results_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'results')
+
+STAGES = ['load', 'build_graph', 'build_dataset', 'train', 'evaluate', 'plot']
+
+# Minutes predicted ahead and the number of 5 minute speeds that takes
+HORIZONS = {15: 3, 30: 6, 45: 9}
+
+# Config of how training metrics are written, which does not change what the stages compute
+SINK_CONFIG = ['METRICS_FLUSH_INTERVAL', 'METRICS_FORMAT', 'TENSORBOARD']
+
+# Modules whose code changes the output of the stages that use them, besides the module of
+# the stage itself
+EDGE_CODE = [inspect.getmodule(distance_to_W1), inspect.getmodule(SensorIndex)]
+MODEL_CODE = [inspect.getmodule(WindowLoader), inspect.getmodule(LeadingSteps)]
+
+def get_splits(dataset, n_slot, splits):
+    split_train, split_val, split_test = splits
+    i = n_slot*split_train
+    j = n_slot*split_val
+    train = dataset[:i]
+    val = dataset[i:i+j]
+    test = dataset[i+j:]
+
+    return train, val, test
+
+def horizon_config(config, n_pred, n_node=None):
+    config = dict(config, N_PRED=n_pred)
+    # Number of possible windows in a day
+    config['N_SLOT'] = config['N_DAY_SLOT'] - (config['N_PRED'] + config['N_HIST']) + 1
+    if n_node is not None:
+        config['N_NODE'] = n_node
+    return config
+
+def load_inputs():
+    vds_info = load_vds_info()
+    sensor_speed, sensor_times = load_sensor_speed()
+    sensor_speed_mean, sensor_speed_std = load_sensor_speed_stats()
+    return {
+        'vds_info': vds_info,
+        'sensor_speed': sensor_speed,
+        'sensor_times': sensor_times,
+        'sensor_speed_mean': sensor_speed_mean,
+        'sensor_speed_std': sensor_speed_std,
+        'sensor_dist': load_sensor_dist(),
+        'sensor_groups': load_sensor_groups(),
+        'sensor_fingerprint': data_fingerprint(),
+        'sensor_index': SensorIndex.from_vds_info(vds_info)
+    }
+
+###### Adjacency Matrices ######
+
+def build_W1(inputs):
+    return distance_to_W1(inputs['sensor_dist'], inputs['sensor_groups'], sparse=True)
+
+def build_W2(inputs, dist_thresh, edge_num_thresh):
+    return distance_to_W2(inputs['sensor_index'], inputs['sensor_groups'], dist_thresh, edge_num_thresh, sparse=True)
+
+def build_W3(inputs, nth_jump, jump_dist_thresh):
+    return distance_to_W3(inputs['sensor_index'], inputs['sensor_groups'], nth_jump, jump_dist_thresh, sparse=True)
+
+# Builder of each adjacency matrix and the config entries it takes, by argument name
+EDGE_STAGES = {
+    'W1': (build_W1, {}),
+    'W2': (build_W2, {'dist_thresh': 'W2_DIST_THRESH', 'edge_num_thresh': 'W2_N_EDGE_THRESH'}),
+    'W3': (build_W3, {'nth_jump': 'W3_NTH_JUMP', 'jump_dist_thresh': 'W3_JUMP_DIST_THRESH'})
+}
+
+class Pipeline:
+    """Train and evaluate a graph for every horizon in HORIZONS.
+
+    Keyword arguments override the graph's config, e.g. GraphPipeline(EPOCHS=5). `workers`
+    is the number of stages that can run at the same time, by default one per core. Models
+    are trained and evaluated one at a time, as torch already uses all its threads for one.
+    What the stages produce is kept on the pipeline:
+
+    - load: `inputs`, a dict of the loaded datasets (see graphs/loaders.py)
+    - build_graph: the (edge_index, edge_weight) of each adjacency matrix in `edges` (W1, W2, ...)
+    - build_dataset: `full_dataset` and `dataloaders`, the (train, val, test) loaders of each horizon
+    - train: `models`, the model of each horizon
+    - evaluate: `results`, the test (RMSE, MAE, MAPE) of each horizon, and `predictions`,
+      the (n_window*n_node, n_pred) predicted and true speeds (y_pred, y_truth) of the test windows
+    - plot: plots of the test predictions in results/{name}
+
+    Graph modules set the class attributes below and implement create_dataset, train_model
+    and evaluate_model.
+    """
+    # Name of the graph module, the results are saved in results/{name}
+    name = None
+    # Printed with the test metrics
+    title = None
+    description = []
+    # Label of the predictions in the plots
+    label = None
+    default_config = {}
+    # Adjacency matrices of the graph, from EDGE_STAGES
+    edges = []
+
+    # Days of the dataset used for training, validation and testing
+    splits = (7, 3, 4)
+
+    def __init__(self, device=None, workers=None, **config):
+        unknown = set(config) - set(self.default_config)
+        if unknown:
+            raise TypeError(f"Unknown config {', '.join(sorted(unknown))} for {self.name}")
+        self.config = dict(self.default_config, **config)
+
+        # Get gpu if you can
+        self.device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+        self.workers = workers or os.cpu_count() or 1
+
+        # Outputs of every stage run by this pipeline, by key
+        self.store = {}
+        self.done = set()
+
+        self.inputs = None
+        self.full_dataset = None
+        self.dataloaders = {}
+        self.models = {}
+        self.results = {}
+        self.predictions = {}
+
+    def run(self, until='plot', skip=(), horizons=None):
+        """Run the stages up to and including `until`, except those in `skip`.
+
+        Stages that already ran or are cached are not run again, so calling run again
+        resumes the pipeline. A skipped stage whose output is needed has to be cached.
+        With `horizons`, e.g. [15], only the models of those horizons are trained, tested
+        and plotted. Returns the test results of each horizon once evaluate has run.
+        """
+        for stage in [until, *skip]:
+            if stage not in STAGES:
+                raise ValueError(f"Unknown stage {stage}, choose from {', '.join(STAGES)}")
+        for minutes in horizons or []:
+            if minutes not in HORIZONS:
+                raise ValueError(f"Unknown horizon {minutes}, choose from {', '.join(map(str, HORIZONS))}")
+
+        graph = self.stage_graph()
+        groups = self.stage_groups(horizons or HORIZONS)
+        targets = [name for stage in STAGES[:STAGES.index(until) + 1] if stage not in skip for name in groups[stage]]
+        skipped = [name for stage in skip for name in groups[stage]]
+        computed = graph.run(targets, self.store, skip=skipped, workers=self.workers)
+        self.collect(graph)
+
+        if any(name in groups['evaluate'] for name in computed):
+            self.report()
+        return self.results
+
+    ###### Stage Graph ######
+
+    def stage_graph(self):
+        # Stages of the current config. The graph module is part of the key of every stage
+        # that runs its code. How metrics are written is left out, so it does not change keys
+        config = {name: value for name, value in self.config.items() if name not in SINK_CONFIG}
+        code = [inspect.getmodule(type(self))]
+        stages = {'load': Stage(load_inputs, version=data_fingerprint(), cache='memory')}
+
+        for edge in self.edges:
+            fn, params = EDGE_STAGES[edge]
+            stages[edge] = Stage(fn, ['load'], {arg: config[name] for arg, name in params.items()},
+                                 code=EDGE_CODE, cache='disk')
+
+        stages['dataset'] = Stage(self.build_dataset, ['load', *self.edges], {'config': config},
+                                  code=[*code, inspect.getmodule(WindowLoader)], cache='memory')
+
+        longest = max(HORIZONS, key=HORIZONS.get)
+        for minutes, n_pred in HORIZONS.items():
+            if config['MULTI_HORIZON']:
+                # A single model is trained for the longest horizon and each horizon uses the
+                # leading N_PRED steps of its predictions
+                stages[f'model_{minutes}'] = Stage(LeadingSteps, ['model'], {'n_pred': n_pred})
+            else:
+                stages[f'model_{minutes}'] = Stage(self.train_horizon, ['load', 'dataset'], {'config': config, 'minutes': minutes},
+                                                   code=[*code, *MODEL_CODE], cache='disk', serial=True)
+            # Serial also because with MULTI_HORIZON the horizons share one model, and GATv2Conv
+            # keeps the attention of its last call on the module
+            stages[f'test_{minutes}'] = Stage(self.test_horizon, ['dataset', f'model_{minutes}'], {'minutes': minutes},
+                                              code=code, serial=True)
+            stages[f'plot_{minutes}'] = Stage(self.plot, ['dataset', f'test_{minutes}'], {'config': config, 'minutes': minutes})
+        if config['MULTI_HORIZON']:
+            stages['model'] = Stage(self.train_horizon, ['load', 'dataset'], {'config': config, 'minutes': longest},
+                                    code=[*code, *MODEL_CODE], cache='disk', serial=True)
+
+        return StageGraph(stages)
+
+    def stage_groups(self, horizons=HORIZONS):
+        # Stages of the stage graph that make up each stage of the pipeline, for the given horizons
+        return {
+            'load': ['load'],
+            'build_graph': list(self.edges),
+            'build_dataset': ['dataset'],
+            'train': [f'model_{minutes}' for minutes in horizons],
+            'evaluate': [f'test_{minutes}' for minutes in horizons],
+            'plot': [f'plot_{minutes}' for minutes in horizons]
+        }
+
+    def collect(self, graph):
+        # Keep the outputs of the current config on the pipeline
+        def available(name):
+            return graph.key(name) in self.store
+
+        def output(name):
+            return self.store[graph.key(name)]
+
+        self.done = {stage for stage, names in self.stage_groups().items() if all(available(name) for name in names)}
+        if available('load'):
+            self.inputs = output('load')
+        for edge in self.edges:
+            if available(edge):
+                setattr(self, edge, output(edge))
+        if available('dataset'):
+            self.full_dataset, self.dataloaders = output('dataset')
+        self.models = {minutes: output(f'model_{minutes}') for minutes in HORIZONS if available(f'model_{minutes}')}
+        self.results, self.predictions = {}, {}
+        for minutes in HORIZONS:
+            if available(f'test_{minutes}'):
+                rmse, mae, mape, y_pred, y_truth = output(f'test_{minutes}')
+                self.results[minutes] = (rmse, mae, mape)
+                self.predictions[minutes] = (y_pred, y_truth)
+
+    ###### Stages ######
+
+    def build_dataset(self, inputs, *edges, config):
+        # Built once for the longest horizon, each horizon is a view of it
+        full_dataset = self.create_dataset(horizon_config(config, max(HORIZONS.values())), inputs, *edges)
+
+        dataloaders = {}
+        for minutes, n_pred in HORIZONS.items():
+            horizon = horizon_config(config, n_pred, full_dataset.n_node)
+            dataset = full_dataset.horizon(n_pred)
+            d_train, d_val, d_test = get_splits(dataset, horizon['N_SLOT'], self.splits)
+            dataloaders[minutes] = (
+                WindowLoader(d_train, batch_size=horizon['BATCH_SIZE'], shuffle=True),
+                WindowLoader(d_val, batch_size=horizon['BATCH_SIZE'], shuffle=True),
+                WindowLoader(d_test, batch_size=horizon['BATCH_SIZE'], shuffle=False)
+            )
+        return full_dataset, dataloaders
+
+    def train_horizon(self, inputs, dataset, config, minutes):
+        full_dataset, dataloaders = dataset
+        train_dataloader, val_dataloader, _ = dataloaders[minutes]
+        print(f"Using {self.device}")
+        # Training metrics of each horizon in their own directory of CHECKPOINT_DIR
+        directory = os.path.join(config['CHECKPOINT_DIR'], f"{self.name}_{minutes}_{time.strftime('%m-%d-%H%M%S')}")
+        with MetricsSink(directory, self.config['METRICS_FLUSH_INTERVAL'], self.config['METRICS_FORMAT'],
+                         self.config['TENSORBOARD']) as sink:
+            return self.train_model(train_dataloader, val_dataloader, horizon_config(config, HORIZONS[minutes], full_dataset.n_node),
+                                    inputs, sink)
+
+    def test_horizon(self, dataset, model, minutes):
+        _, dataloaders = dataset
+        _, _, test_dataloader = dataloaders[minutes]
+        return self.evaluate_model(model, test_dataloader)
+
+    def plot(self, dataset, test, config, minutes):
+        full_dataset, _ = dataset
+        _, _, _, y_pred, y_truth = test
+        os.makedirs(os.path.join(results_directory, self.name), exist_ok=True)
+        self.plot_prediction(y_pred, y_truth, horizon_config(config, HORIZONS[minutes], full_dataset.n_node), minutes, 0)
+
+    ###### Implemented by the graph modules ######
+
+    def create_dataset(self, config, inputs, *edges):
+        # The dataset of the graph with the adjacency matrices in `edges`
+        raise NotImplementedError
+
+    def train_model(self, train_dataloader, val_dataloader, config, inputs, sink):
+        # Train a model, writing its training metrics to the MetricsSink `sink`
+        raise NotImplementedError
+
+    def evaluate_model(self, model, dataloader):
+        # Returns rmse, mae, mape, y_pred, y_truth on the dataloader
+        raise NotImplementedError
+
+    ###### Results ######
+
+    def plot_prediction(self, y_pred, y_truth, config, minutes, node):
+        # Calculate the truth
+        s = y_truth.shape
+        y_truth = y_truth.reshape(-1, config['N_NODE'], s[-1])
+        # just get the first prediction out for the nth node, for every window of the test dataset
+        y_truth = y_truth[:, node, 0]
+        day1_truth = y_truth[config['N_SLOT']:2*config['N_SLOT']]
+
+        # Calculate the predicted
+        s = y_pred.shape
+        y_pred = y_pred.reshape(-1, config['N_NODE'], s[-1])
+        # just get the first prediction out for the nth node, for every window of the test dataset
+        y_pred = y_pred[:, node, 0]
+        # Just grab the second day
+        day1_pred = y_pred[config['N_SLOT']:2*config['N_SLOT']]
+        t = [t for t in range(0, config['N_SLOT']*5, 5)]
+        # A Figure without pyplot, the plot stage runs in a worker thread where GUI backends do not work
+        fig = Figure()
+        ax = fig.subplots()
+        ax.plot(t, day1_pred, label=self.label)
+        ax.plot(t, day1_truth, label='truth')
+        ax.set_xlabel('Time (minutes)')
+        ax.set_ylabel('Speed prediction (mph)')
+        ax.set_title('Predictions of traffic over one day at one sensor')
+        ax.legend()
+        fig.savefig(os.path.join(results_directory, self.name, f'{self.name}_{minutes}.png'))
+
+    def report(self):
+        print('-------------------------------------------------------------------------------')
+        print(f'\n{self.title}')
+        print('-' * len(self.title))
+        for line in self.description:
+            print(line)
+        print()
+        for minutes, (rmse, mae, mape) in self.results.items():
+            print(f'Test Evals for {minutes} mins: RMSE: {rmse}, MAE: {mae}, MAPE: {mape}')
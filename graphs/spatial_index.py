@@ -0,0 +1,94 @@
+# Spatial index over sensor locations
+#
+# Sensors are placed on a sphere (in 3D coordinates) and stored in a KD-tree, so radius and
+# k-nearest neighbour queries cost O(log N) per sensor instead of a full row of the distance
+# matrix. Straight-line (chord) distances through the sphere increase with great-circle
+# distance, so neighbours found by the tree are exactly the haversine neighbours.
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Radius of the earth in miles, same as data/create_datasets.py
+EARTH_RADIUS = 3956
+
+def haversine(lat1, lon1, lat2, lon2):
+    # Distance (miles) between coordinates, elementwise on arrays
+    p = np.pi / 180
+    a = 0.5 - np.cos((lat2-lat1)*p)/2 + np.cos(lat1*p) * np.cos(lat2*p) * (1-np.cos((lon2-lon1)*p))/2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+def miles_to_chord(miles):
+    # Straight-line distance through the sphere between points `miles` apart on the surface
+    return 2 * EARTH_RADIUS * np.sin(np.minimum(miles / EARTH_RADIUS, np.pi) / 2)
+
+class SensorIndex:
+    def __init__(self, lat, lng):
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lng = np.asarray(lng, dtype=np.float64)
+
+        lat_rad = np.radians(self.lat)
+        lng_rad = np.radians(self.lng)
+        points = EARTH_RADIUS * np.stack([
+            np.cos(lat_rad) * np.cos(lng_rad),
+            np.cos(lat_rad) * np.sin(lng_rad),
+            np.sin(lat_rad)
+        ], axis=1)
+        self.tree = cKDTree(points)
+
+    @classmethod
+    def from_vds_info(cls, vds_info):
+        return cls(vds_info['Lat'].values, vds_info['Lng'].values)
+
+    def __len__(self):
+        return len(self.lat)
+
+    def distance(self, src, dst):
+        # Haversine distance (miles) between pairs of sensors given by index arrays
+        return haversine(self.lat[src], self.lng[src], self.lat[dst], self.lng[dst])
+
+    def query_radius(self, radius):
+        """All ordered pairs of distinct sensors at most `radius` miles apart.
+
+        Returns (src, dst, dist) arrays sorted by src then dst, each pair appearing in both
+        directions.
+        """
+        pairs = self.tree.query_pairs(miles_to_chord(radius), output_type='ndarray')
+        src = np.concatenate([pairs[:, 0], pairs[:, 1]]).astype(np.int64)
+        dst = np.concatenate([pairs[:, 1], pairs[:, 0]]).astype(np.int64)
+
+        # Tree distances are compared in chord space, confirm with the haversine distance
+        dist = self.distance(src, dst)
+        keep = dist <= radius
+        src, dst, dist = src[keep], dst[keep], dist[keep]
+
+        order = np.lexsort((dst, src))
+        return src[order], dst[order], dist[order]
+
+    def query_knn(self, k, max_radius=np.inf):
+        """The k nearest other sensors of every sensor, at most `max_radius` miles away.
+
+        Returns (src, dst, dist) arrays sorted by src then distance. Sensors with fewer than
+        k neighbours in range get fewer pairs.
+        """
+        n = len(self)
+        k = min(k, n - 1)
+        if k <= 0:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, np.zeros(0)
+
+        upper = miles_to_chord(max_radius) if np.isfinite(max_radius) else np.inf
+        _, dst = self.tree.query(self.tree.data, k=k+1, distance_upper_bound=upper)
+        src = np.repeat(np.arange(n), k+1)
+        dst = dst.reshape(-1)
+
+        # Drop missing neighbours (returned as index n) and each sensor itself
+        keep = (dst < n) & (dst != src)
+        src, dst = src[keep], dst[keep].astype(np.int64)
+        dist = self.distance(src, dst)
+
+        # Sensors sharing a location with others can leave k+1 real neighbours
+        order = np.lexsort((dist, src))
+        src, dst, dist = src[order], dst[order], dist[order]
+        rank = np.arange(len(src)) - np.searchsorted(src, src)
+        keep = (rank < k) & (dist <= max_radius)
+        return src[keep], dst[keep], dist[keep]
@@ -0,0 +1,144 @@
+# Graph of pipeline stages with outputs cached by content
+#
+# A stage declares the stages whose outputs it takes as inputs and the parameters it depends
+# on. Its key is a hash of its name, its parameters, the source of the code it runs and the
+# keys of its inputs, so stages with the same key compute the same output whatever pipeline
+# they are part of: W1 is built once and reused by every graph that has type 1 edges.
+#
+# Changing a parameter changes the key of the stage that uses it and of every stage
+# downstream of it. Stages upstream keep their keys and are not computed again.
+#
+# Outputs are kept in the store of the caller. Stages with cache='memory' also keep them for
+# the rest of the process, and stages with cache='disk' save them in data/processed/stages so
+# later runs and other processes (see run.py) reuse them. Stages whose inputs are ready run
+# side by side in a pool of threads, except serial stages, which run one at a time.
+
+import os
+import json
+import hashlib
+import inspect
+import functools
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import torch
+
+from graphs.loaders import data_directory
+
+stage_directory = os.path.join(data_directory, 'processed', 'stages')
+
+# Outputs of the stages with cache='memory' or 'disk', by key, shared by all pipelines of the process
+memory_cache = {}
+
+@functools.lru_cache(maxsize=None)
+def source_hash(module):
+    with open(inspect.getsourcefile(module), 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+class Stage:
+    """Step of a pipeline, computes fn(*outputs of inputs, **params).
+
+    The source of the module of fn and of the modules in `code` is part of the key, so
+    changing the code of a stage computes it again. `version` is added to the key without
+    being passed to fn, e.g. the fingerprint of the data a stage loads. `cache` is None,
+    'memory' or 'disk'. A serial stage never runs at the same time as another serial stage,
+    e.g. stages that already use all the threads of torch.
+    """
+    def __init__(self, fn, inputs=(), params=None, code=(), version='', cache=None, serial=False):
+        self.fn = fn
+        self.inputs = list(inputs)
+        self.params = params or {}
+        self.version = version
+        self.code = [inspect.getmodule(fn), *code]
+        self.cache = cache
+        self.serial = serial
+
+class StageGraph:
+    def __init__(self, stages):
+        self.stages = stages
+        self.keys = {}
+
+    def key(self, name):
+        if name not in self.keys:
+            stage = self.stages[name]
+            key = hashlib.sha1()
+            key.update(name.encode())
+            key.update(stage.fn.__qualname__.encode())
+            key.update(json.dumps(stage.params, sort_keys=True, default=repr).encode())
+            key.update(stage.version.encode())
+            for module in stage.code:
+                key.update(source_hash(module).encode())
+            for input in stage.inputs:
+                key.update(self.key(input).encode())
+            self.keys[name] = key.hexdigest()[:16]
+        return self.keys[name]
+
+    def path(self, name):
+        return os.path.join(stage_directory, f'{name}_{self.key(name)}.pt')
+
+    def cached(self, name, store):
+        # Whether the output is in the store, after fetching it from the caches if it is there
+        key = self.key(name)
+        if key in store:
+            return True
+        cache = self.stages[name].cache
+        if cache is not None and key in memory_cache:
+            store[key] = memory_cache[key]
+            return True
+        if cache == 'disk' and os.path.exists(self.path(name)):
+            store[key] = memory_cache[key] = torch.load(self.path(name), map_location='cpu', weights_only=False)
+            return True
+        return False
+
+    def compute(self, name, store):
+        stage = self.stages[name]
+        output = stage.fn(*[store[self.key(input)] for input in stage.inputs], **stage.params)
+        key = self.key(name)
+        store[key] = output
+        if stage.cache is not None:
+            memory_cache[key] = output
+        if stage.cache == 'disk':
+            # Written under a temporary name and renamed, so other processes never read a partial file
+            os.makedirs(stage_directory, exist_ok=True)
+            path = self.path(name)
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            torch.save(output, tmp_path)
+            os.replace(tmp_path, path)
+
+    def run(self, targets, store, skip=(), workers=1):
+        """Make the outputs of the targets available in store, a dict from key to output.
+
+        Only the stages whose output is in neither the store nor the caches are computed,
+        together with the inputs they need. Stages in `skip` are never computed. Returns the
+        names of the stages that were computed.
+        """
+        # Stages to compute, with the inputs that have to be computed before them
+        pending = {}
+
+        def visit(name):
+            if name in pending or self.cached(name, store):
+                return
+            if name in skip:
+                raise RuntimeError(f'Stage {name} is skipped, but its output is needed and not cached')
+            pending[name] = set()
+            for input in self.stages[name].inputs:
+                visit(input)
+            pending[name] = {input for input in self.stages[name].inputs if input in pending}
+
+        for name in targets:
+            visit(name)
+
+        computed = list(pending)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            running = {}
+            while pending or running:
+                for name in [name for name, waiting in pending.items() if not waiting]:
+                    if self.stages[name].serial and any(self.stages[other].serial for other in running.values()):
+                        continue
+                    del pending[name]
+                    running[pool.submit(self.compute, name, store)] = name
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    future.result()
+                    for waiting in pending.values():
+                        waiting.discard(name)
+        return computed
@@ -1,43 +1,134 @@
-import sys
+# Train and evaluate the graphs, then print the test metrics of all of them in one table
+#
+#     python run.py [graph ...] [--workers N] [--threads N]
+#
+# The horizons of every graph are trained side by side in a pool of worker processes, each
+# using its share of the cores. Inputs are loaded once before the pool starts and the
+# workers, forked from this process, share them. Adjacency matrices and datasets are cached
+# on disk (see graphs/stages.py), so the workers of a graph's horizons share them. The output
+# of each horizon goes to results/{graph}/{graph}_{minutes}.log when they run in parallel,
+# and the metrics table is saved to results/results.csv.
 
+import argparse
+import contextlib
+import functools
+import importlib
+import multiprocessing
+import os
+import time
+import pandas as pd
+
+from graphs.loaders import preload
+from graphs.pipeline import HORIZONS
+
+GRAPHS = [
+    'Graph1_SingleEdge', 'Graph2_SingleEdge', 'Graph3_SingleEdge', 'Graph4_SingleEdge', 'Graph5_SingleEdge', 'Graph6_SingleEdge',
+    'Graph1_EdgeType', 'Graph2_EdgeType', 'Graph3_EdgeType', 'Graph4_EdgeType', 'Graph5_EdgeType', 'Graph6_EdgeType'
+]
+
+results_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+def init_worker(threads):
+    # Split the cores between the workers instead of every worker using all of them
+    import torch
+    torch.set_num_threads(threads)
+
+def run_graph(graph, threads, horizons=None, log=False):
+    """Run the pipeline of a graph, return its test metrics as one row per horizon and its run time.
+
+    With `horizons` only the models of those horizons are trained and evaluated. Up to
+    `threads` stages of the pipeline run at the same time, but only one of them trains or
+    evaluates a model with torch, so the graph uses at most `threads` torch threads. With
+    log, everything the graph prints is written to results/{graph}/{graph}.log, or
+    results/{graph}/{graph}_{minutes}.log for one horizon.
+    """
+    sta = time.time()
+    with contextlib.ExitStack() as stack:
+        if log:
+            name = graph if horizons is None else '_'.join([graph, *map(str, horizons)])
+            os.makedirs(os.path.join(results_directory, graph), exist_ok=True)
+            log_file = stack.enter_context(open(os.path.join(results_directory, graph, f'{name}.log'), 'w'))
+            stack.enter_context(contextlib.redirect_stdout(log_file))
+            stack.enter_context(contextlib.redirect_stderr(log_file))
+        pipeline = importlib.import_module(f'graphs.{graph}').GraphPipeline(workers=threads)
+        results = pipeline.run(horizons=horizons)
+
+    rows = [{
+        'graph': graph,
+        'horizon': f'{minutes} mins',
+        'RMSE': float(rmse),
+        'MAE': float(mae),
+        'MAPE': float(mape)
+    } for minutes, (rmse, mae, mape) in results.items()]
+    return rows, time.time() - sta
+
+def run_task(task, threads):
+    graph, horizons = task
+    return run_graph(graph, threads, horizons, log=True)
+
+def graph_tasks(graphs):
+    # One task per horizon of every graph, so all of them are spread over the workers. A graph
+    # with MULTI_HORIZON trains one model for all its horizons and stays a single task
+    tasks = []
+    for graph in graphs:
+        if importlib.import_module(f'graphs.{graph}').GraphPipeline.default_config['MULTI_HORIZON']:
+            tasks.append((graph, None))
+        else:
+            tasks += [(graph, [minutes]) for minutes in HORIZONS]
+    return tasks
+
+def results_table(rows, graphs):
+    # One row per graph in the order they were asked for, RMSE/MAE/MAPE for each horizon
+    table = pd.DataFrame(rows).pivot(index='graph', columns='horizon', values=['RMSE', 'MAE', 'MAPE'])
+    table = table.swaplevel(axis=1)[[f'{horizon} mins' for horizon in HORIZONS]]
+    return table.reindex(graphs)
+
+def main():
+    parser = argparse.ArgumentParser(description='Train and evaluate the graphs, all of them if none are given')
+    parser.add_argument('graphs', nargs='*', help='names of the graphs to evaluate, as in the README')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of horizons trained in parallel, by default one per core up to the number of horizons of all graphs')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='torch threads per worker, by default the cores divided between the workers')
+    args = parser.parse_args()
+
+    unknown = [graph for graph in args.graphs if graph not in GRAPHS]
+    if unknown:
+        parser.error(f"unknown graphs {', '.join(unknown)}, choose from {', '.join(GRAPHS)}")
+    graphs = args.graphs or GRAPHS
+
+    tasks = graph_tasks(graphs)
+    cores = os.cpu_count() or 1
+    workers = args.workers or min(len(tasks), cores)
+    threads = args.threads or max(1, cores // workers)
+
+    preload()
+    rows = []
+    if workers == 1:
+        # Run in this process with the output shown as it comes
+        if args.threads:
+            init_worker(threads)
+        for graph in graphs:
+            graph_rows, _ = run_graph(graph, threads)
+            rows += graph_rows
+    else:
+        print(f'Running {len(graphs)} graphs as {len(tasks)} tasks on {workers} workers with {threads} threads each, logs in {results_directory}')
+
+        # Forked workers share the inputs loaded by preload. A new worker for every task, so
+        # tasks do not share module state
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+        with context.Pool(workers, initializer=init_worker, initargs=(threads,), maxtasksperchild=1) as pool:
+            for graph_rows, run_time in pool.imap_unordered(functools.partial(run_task, threads=threads), tasks):
+                horizons = ', '.join(row['horizon'] for row in graph_rows)
+                print(f'{graph_rows[0]["graph"]} {horizons} done in {run_time / 60:.1f} min')
+                rows += graph_rows
+
+    table = results_table(rows, graphs)
+    os.makedirs(results_directory, exist_ok=True)
+    table.to_csv(os.path.join(results_directory, 'results.csv'))
+    print('\nTest metrics')
+    print(table.to_string(float_format=lambda value: f'{value:.3f}'))
 
 if __name__ == '__main__':
-    targets = sys.argv[1:]
-    if len(targets) == 0:
-        from graphs import Graph1_SingleEdge, Graph2_SingleEdge, Graph3_SingleEdge, Graph4_SingleEdge, Graph5_SingleEdge, Graph6_SingleEdge, Graph1_EdgeType, Graph2_EdgeType, Graph3_EdgeType, Graph4_EdgeType, Graph5_EdgeType, Graph6_EdgeType
-    
-    if 'Graph1_SingleEdge' in targets:
-        from graphs import Graph1_SingleEdge
-    
-    if 'Graph2_SingleEdge' in targets:
-        from graphs import Graph2_SingleEdge
-    
-    if 'Graph3_SingleEdge' in targets:
-        from graphs import Graph3_SingleEdge
-    
-    if 'Graph4_SingleEdge' in targets:
-        from graphs import Graph4_SingleEdge
-
-    if 'Graph5_SingleEdge' in targets:
-        from graphs import Graph5_SingleEdge
-    
-    if 'Graph6_SingleEdge' in targets:
-        from graphs import Graph6_SingleEdge
-    
-    if 'Graph1_EdgeType' in targets:
-        from graphs import Graph1_EdgeType
-
-    if 'Graph2_EdgeType' in targets:
-        from graphs import Graph2_EdgeType
-    
-    if 'Graph3_EdgeType' in targets:
-        from graphs import Graph3_EdgeType
-
-    if 'Graph4_EdgeType' in targets:
-        from graphs import Graph4_EdgeType
-
-    if 'Graph5_EdgeType' in targets:
-        from graphs import Graph5_EdgeType
-    
-    if 'Graph6_EdgeType' in targets:
-        from graphs import Graph6_EdgeType
\ No newline at end of file
+    main()